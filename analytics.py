@@ -0,0 +1,144 @@
+import csv
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from deco import DiveProfile, DiveProfileCheckpoint, Buhlmann_Z16C, process_algorithms, air
+
+def read_log(path):
+    # a log is a depth series like simons_reef, one sample every sample_s seconds, separated by commas or whitespace
+    with open(path) as f:
+        depths = [float(depth) for depth in re.split(r'[,\s]+', f.read()) if depth]
+    if not depths:
+        raise Exception("no depth samples in {}".format(path))
+    return depths
+
+def read_logs(directory):
+    # yields (name, path): logs are read by analyse_log, so one unreadable file only costs its own row
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            yield filename, path
+
+def make_dive_from_log(depths, sample_s=20, gas=air):
+    checkpoints = [DiveProfileCheckpoint(time=0, depth=0, gas=gas)]
+    for i, depth in enumerate(depths):
+        checkpoints.append(DiveProfileCheckpoint(time=(i+1)*sample_s, depth=depth, gas=gas))
+    if checkpoints[-1].depth > 0:
+        # computers stop logging just below the surface, so count the dive as surfacing one sample later
+        checkpoints.append(DiveProfileCheckpoint(time=(len(depths)+1)*sample_s, depth=0, gas=gas))
+    return DiveProfile(checkpoints=checkpoints)
+
+def summary_columns(algorithm):
+    return [
+        'dive', 'max_depth', 'runtime_min', 'peak_ceiling', 'min_ndl', 'valid', 'first_violation_min',
+        *['end_ppn2_{}min'.format(compartment.half_time_min) for compartment in algorithm.compartments],
+        'error'
+    ]
+
+def analyse_log(name, depths, sample_s=20, gas=air, algorithm=None):
+    # one summary row for one logged dive. depths is a depth series, or the path of a log to read it from.
+    # min_ndl is the shortest no decompression limit in minutes over the dive, 0 once it needed stops
+    if algorithm == None:
+        algorithm = Buhlmann_Z16C()
+    if isinstance(depths, str):
+        depths = read_log(depths)
+    dive = make_dive_from_log(depths, sample_s=sample_s, gas=gas)
+    results = process_algorithms(dive, [algorithm])[algorithm]
+    first_invalid_time = results.first_invalid_time
+    return [
+        name,
+        max([checkpoint.depth for checkpoint in dive.profile]),
+        dive.profile[-1].time / 60,
+        float(results.ceiling.max()),
+        max(0, float(results.ndl.min())),
+        results.valid,
+        None if first_invalid_time == None else first_invalid_time / 60,
+        *results.ppn2[-1].tolist(),
+        None
+    ]
+
+def error_row(name, error, algorithm):
+    return [name, *[None] * (len(summary_columns(algorithm)) - 2), '{}: {}'.format(type(error).__name__, error)]
+
+def analyse_log_task(task):
+    name, depths, sample_s, gas, algorithm = task
+    try:
+        return analyse_log(name, depths, sample_s, gas, algorithm)
+    except Exception as e:
+        return error_row(name, e, algorithm)
+
+class FleetSummary():
+    # aggregate statistics over every analysed dive, updated as rows stream in
+    def __init__(self) -> None:
+        self.dives = 0
+        self.errors = 0
+        self.dives_with_violations = 0
+        self.max_depth = 0
+        self.max_runtime_min = 0
+        self.max_peak_ceiling = 0
+        self.total_runtime_min = 0
+
+    def add(self, row):
+        if row[-1] != None:
+            self.errors = self.errors + 1
+            return None
+        name, max_depth, runtime_min, peak_ceiling, min_ndl, valid = row[:6]
+        self.dives = self.dives + 1
+        self.dives_with_violations = self.dives_with_violations + (0 if valid else 1)
+        self.max_depth = max(self.max_depth, max_depth)
+        self.max_runtime_min = max(self.max_runtime_min, runtime_min)
+        self.max_peak_ceiling = max(self.max_peak_ceiling, peak_ceiling)
+        self.total_runtime_min = self.total_runtime_min + runtime_min
+
+    def save(self, path):
+        # rewritten whole and swapped in, so a reader never sees half a summary
+        with open(path + '.tmp', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['statistic', 'value'])
+            writer.writerows(self.__dict__.items())
+        os.replace(path + '.tmp', path)
+
+    def __repr__(self) -> str:
+        return str(self.__dict__)
+
+    def __str__(self):
+        return str(self.__dict__)
+
+def analyse_logs(logs, results_path, sample_s=20, gas=air, algorithm=None, executor=None, summary_path=None, summary_every=100, max_pending=256):
+    # logs is a directory or an iterable of (name, depths). rows are written to results_path as a csv as soon as
+    # each dive is analysed, in the order they finish. a log that can't be read or analysed gets a row with only
+    # its error. the aggregate statistics are saved to summary_path every summary_every rows and at the end, and
+    # returned. at most max_pending logs are queued on the executor at once
+    if algorithm == None:
+        algorithm = Buhlmann_Z16C()
+    if isinstance(logs, str):
+        logs = read_logs(logs)
+    if summary_path == None:
+        summary_path = os.path.splitext(results_path)[0] + '_summary.csv'
+    if executor == None:
+        with ProcessPoolExecutor() as pool:
+            return analyse_logs(logs, results_path, sample_s, gas, algorithm, pool, summary_path, summary_every, max_pending)
+
+    summary = FleetSummary()
+    with open(results_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(summary_columns(algorithm))
+
+        def write(futures):
+            for future in futures:
+                row = future.result()
+                writer.writerow(row)
+                f.flush()
+                summary.add(row)
+                if (summary.dives + summary.errors) % summary_every == 0:
+                    summary.save(summary_path)
+
+        pending = set()
+        for name, depths in logs:
+            pending.add(executor.submit(analyse_log_task, (name, depths, sample_s, gas, algorithm)))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(done)
+        write(as_completed(pending))
+    summary.save(summary_path)
+    return summary
@@ -0,0 +1,232 @@
+import io
+import os
+import shutil
+import numpy as np
+from deco import DiveProfile, DiveProfileCheckpoint, Buhlmann_Z16C, BuhlmannState, Gas
+
+# An archive is a directory of .npy files, so every table can be memory-mapped on load:
+#   header.npy  format version and number of compartments
+#   gases.npy   one row per distinct gas
+#   dives.npy   one row per dive: row offsets into samples.npy and algorithm parameters
+#   samples.npy one row per second of every dive: time/depth/gas, tissue matrices and validation flag
+# bump FORMAT_VERSION whenever any of these layouts change
+FORMAT_VERSION = 1
+
+HEADER_DTYPE = np.dtype([('version', np.int32), ('n_compartments', np.int32)])
+GAS_DTYPE = np.dtype([('oxygen', np.float64), ('helium', np.float64), ('ppo2', np.float64)])
+DIVE_DTYPE = np.dtype([
+    ('start', np.int64),
+    ('stop', np.int64),
+    ('gf_hi', np.float64),
+    ('gf_lo', np.float64),
+    ('valid', np.bool_),
+])
+
+def samples_dtype(n_compartments):
+    return np.dtype([
+        ('time', np.float64),
+        ('depth', np.float64),
+        ('gas', np.int32),
+        ('ppn2', np.float64, (n_compartments,)),
+        ('ceiling', np.float64, (n_compartments,)),
+        ('ndl', np.float64, (n_compartments,)),
+        ('valid', np.bool_),
+    ])
+
+def gas_ppo2(gas: Gas):
+    # Gas only keeps the MOD, so recover the ppO2 it was made with
+    return round((gas.mod + 10) * gas.oxygen / 10, 4)
+
+def as_number(value):
+    # keep whole numbers as ints, so rebuilt gas ids and graph titles match the originals
+    return int(value) if value == int(value) else value
+
+def as_percent(fraction):
+    return as_number(round(fraction * 100, 4))
+
+def dive_samples(dive, n_compartments, gas_ids, gas_rows):
+    # the samples table rows for one processed dive. new gases are added to gas_ids and gas_rows
+    samples = np.zeros(len(dive), dtype=samples_dtype(n_compartments))
+    for i, checkpoint in enumerate(dive.profile):
+        state = checkpoint.state
+        if not state:
+            raise Exception("dive profile must be processed by an algorithm before archiving")
+        if checkpoint.gas.id not in gas_ids:
+            gas_ids[checkpoint.gas.id] = len(gas_rows)
+            gas_rows.append((checkpoint.gas.oxygen, checkpoint.gas.helium, gas_ppo2(checkpoint.gas)))
+        samples[i] = (
+            checkpoint.time,
+            checkpoint.depth,
+            gas_ids[checkpoint.gas.id],
+            [compartment.ppn2 for compartment in state],
+            [compartment.ceiling for compartment in state],
+            [compartment.ndl for compartment in state],
+            bool(checkpoint.validation),
+        )
+    return samples
+
+def append_npy(path, rows):
+    # appends rows to a 1-d .npy file in place: rewrite the shape in the header, then add the bytes at the end
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_length = f.tell()
+        if dtype != rows.dtype or fortran_order or len(shape) != 1:
+            raise Exception("cannot append to {}, its layout does not match".format(path))
+        header = io.BytesIO()
+        header_data = {
+            'descr': np.lib.format.dtype_to_descr(dtype),
+            'fortran_order': False,
+            'shape': (shape[0] + len(rows),)}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, header_data)
+        else:
+            np.lib.format.write_array_header_2_0(header, header_data)
+        if len(header.getvalue()) == header_length:
+            f.seek(0, os.SEEK_END)
+            f.write(rows.tobytes())
+            f.seek(0)
+            f.write(header.getvalue())
+            return None
+    # numpy leaves room in the header for the shape to grow, so this rewrite should be rare
+    old_rows = np.load(path, mmap_mode='r')
+    new_path = path + '.tmp'
+    new_rows = np.lib.format.open_memmap(new_path, mode='w+', dtype=rows.dtype, shape=(len(old_rows) + len(rows),))
+    new_rows[:len(old_rows)] = old_rows
+    new_rows[len(old_rows):] = rows
+    new_rows.flush()
+    del new_rows, old_rows
+    os.replace(new_path, path)
+
+def save_archive(path, dives):
+    # starts a new archive at path, replacing any archive already there.
+    # dives is an iterable of (DiveProfile, Buhlmann_Z16C) pairs, each profile already processed by its algorithm.
+    # the new archive is written next to the old one and only moved into place once it holds every dive, so an
+    # empty or failing input leaves the old archive untouched
+    new_path = os.path.normpath(path) + '.new'
+    if os.path.exists(new_path):
+        shutil.rmtree(new_path)
+    try:
+        if not append_archive(new_path, dives):
+            raise Exception("cannot save an empty archive")
+        os.makedirs(path, exist_ok=True)
+        for filename in ['header.npy', 'gases.npy', 'samples.npy', 'dives.npy']:
+            os.replace(os.path.join(new_path, filename), os.path.join(path, filename))
+    finally:
+        if os.path.exists(new_path):
+            shutil.rmtree(new_path)
+
+def append_archive(path, dives):
+    # adds dives to the archive at path, creating it if needed. dives are written one at a time, so neither the
+    # archive nor the new dives are ever held in memory together. returns the number of dives added
+    header_path = os.path.join(path, 'header.npy')
+    gas_ids = {}
+    gas_rows = []
+    dive_rows = []
+    n_compartments = None
+    start = 0
+    if os.path.exists(header_path):
+        archive = DiveArchive(path)
+        n_compartments = archive.n_compartments
+        gas_rows = [tuple(row.tolist()) for row in archive.gases]
+        gas_ids = dict([(archive.gas(i).id, i) for i in range(len(gas_rows))])
+        dive_rows = [tuple(row.tolist()) for row in archive.dives]
+        start = len(archive.samples)
+        del archive
+
+    added = 0
+    for dive, algorithm in dives:
+        if n_compartments == None:
+            n_compartments = len(algorithm.compartments)
+            os.makedirs(path, exist_ok=True)
+            np.save(os.path.join(path, 'samples.npy'), np.zeros(0, dtype=samples_dtype(n_compartments)))
+            np.save(header_path, np.array([(FORMAT_VERSION, n_compartments)], dtype=HEADER_DTYPE))
+        if len(algorithm.compartments) != n_compartments:
+            raise Exception("all dives in an archive must use the same number of compartments")
+        samples = dive_samples(dive, n_compartments, gas_ids, gas_rows)
+        append_npy(os.path.join(path, 'samples.npy'), samples)
+        stop = start + len(samples)
+        dive_rows.append((start, stop, algorithm.gf_hi, algorithm.gf_lo, bool(samples['valid'].all())))
+        start = stop
+        added = added + 1
+
+    if added:
+        # samples first, so the small tables never point past the end of samples.npy
+        np.save(os.path.join(path, 'gases.npy'), np.array(gas_rows, dtype=GAS_DTYPE))
+        np.save(os.path.join(path, 'dives.npy'), np.array(dive_rows, dtype=DIVE_DTYPE))
+    return added
+
+class DiveArchive:
+    def __init__(self, path, mmap_mode='r') -> None:
+        self.path = path
+        header = np.load(os.path.join(path, 'header.npy'))
+        self.version = int(header['version'][0])
+        if self.version != FORMAT_VERSION:
+            raise Exception("archive format version {} is not supported, expected {}".format(self.version, FORMAT_VERSION))
+        self.n_compartments = int(header['n_compartments'][0])
+        self.gases = np.load(os.path.join(path, 'gases.npy'))
+        self.dives = np.load(os.path.join(path, 'dives.npy'), mmap_mode=mmap_mode)
+        # the big table: nothing is read from disk until a dive or window is sliced out of it
+        self.samples = np.load(os.path.join(path, 'samples.npy'), mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return len(self.dives)
+
+    def __getitem__(self, key):
+        return self.dive(key)
+
+    def dive(self, index):
+        # all samples of one dive, as a view into the memory-mapped table
+        row = self.dives[index]
+        return self.samples[row['start']:row['stop']]
+
+    def window(self, index, start_s, stop_s):
+        # samples of one dive with start_s <= time <= stop_s
+        samples = self.dive(index)
+        times = samples['time']
+        first = np.searchsorted(times, start_s, side='left')
+        last = np.searchsorted(times, stop_s, side='right')
+        return samples[first:last]
+
+    def algorithm(self, index):
+        row = self.dives[index]
+        algorithm = Buhlmann_Z16C(gf=as_number(row['gf_hi'].item()))
+        algorithm.gf_lo = as_number(row['gf_lo'].item())
+        return algorithm
+
+    def gas(self, gas_index):
+        row = self.gases[gas_index]
+        return Gas(
+            oxygen=as_percent(row['oxygen'].item()),
+            helium=as_percent(row['helium'].item()),
+            ppo2=row['ppo2'].item())
+
+    def load_profile(self, index):
+        # rebuild the object model for one dive, e.g. to graph it; returns (DiveProfile, Buhlmann_Z16C)
+        algorithm = self.algorithm(index)
+        gases = {}
+        checkpoints = []
+        for sample in self.dive(index):
+            gas_index = int(sample['gas'])
+            if gas_index not in gases:
+                gases[gas_index] = self.gas(gas_index)
+            checkpoint = DiveProfileCheckpoint(
+                time=sample['time'].item(),
+                depth=sample['depth'].item(),
+                gas=gases[gas_index],
+                validation=bool(sample['valid']))
+            # the archived values, not recomputed ones, so the profile matches the archive exactly
+            checkpoint.state = BuhlmannState(
+                algorithm.compartments,
+                cur_checkpoint=checkpoint,
+                ppn2s=sample['ppn2'].tolist(),
+                ceilings=sample['ceiling'].tolist(),
+                ndls=sample['ndl'].tolist())
+            checkpoints.append(checkpoint)
+        # the samples are already exploded to one per second, so don't explode them again
+        dive = DiveProfile(checkpoints=checkpoints[:1])
+        dive.profile = checkpoints
+        return dive, algorithm
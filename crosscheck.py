@@ -0,0 +1,166 @@
+import random
+import numpy as np
+from deco import DiveProfile, DiveProfileCheckpoint, Buhlmann_Z16C, BuhlmannState, process_algorithms, results_from_checkpoints
+from planner import (
+    ChangeDepth, MaintainDepth, GetMeHome, process_diveplan, PLANNER_REJECTIONS,
+    air, air_tec, eanx32, eanx32_tec, eanx36, eanx36_tec, trimix_21_35, deco_gases
+)
+
+# bottom gases that are breathable from the surface, so random plans can start on them
+RANDOM_BOTTOM_GASES = [air, air_tec, eanx32, eanx32_tec, eanx36, eanx36_tec, trimix_21_35]
+
+def batched_engine(dive_profile, algorithm):
+    return process_algorithms(dive_profile, [algorithm])[algorithm]
+
+# fast engines to check against the per-second object model. each takes (DiveProfile, algorithm) and returns
+# DiveResults without writing to the profile
+ENGINES = {
+    'batched': batched_engine,
+}
+
+def reference_engine(dive_profile, algorithm):
+    algorithm.process(dive_profile)
+    return results_from_checkpoints(algorithm, dive_profile)
+
+class Divergence():
+    # the first point where a fast engine disagrees with the reference, with the seconds around it
+    def __init__(self, field, index, compartment, reference, fast, context_s=5) -> None:
+        dive_profile = reference.dive_profile
+        checkpoint = dive_profile.profile[index]
+        self.field = field
+        self.index = index
+        self.time = checkpoint.time
+        self.depth = checkpoint.depth
+        self.gas = checkpoint.gas
+        self.compartment = compartment
+        self.half_time_min = None if compartment == None else reference.algorithm.compartments[compartment].half_time_min
+        self.reference_value = self.value(reference, field, index, compartment)
+        self.fast_value = self.value(fast, field, index, compartment)
+        self.context = []
+        for i in range(max(0, index - context_s), min(len(dive_profile), index + context_s + 1)):
+            self.context.append((
+                dive_profile.profile[i].time,
+                dive_profile.profile[i].depth,
+                dive_profile.profile[i].gas.id,
+                self.value(reference, field, i, compartment),
+                self.value(fast, field, i, compartment)))
+
+    @staticmethod
+    def value(results, field, index, compartment):
+        values = getattr(results, field)[index]
+        return values.item() if compartment == None else values[compartment].item()
+
+    def __repr__(self) -> str:
+        return str((self.field, self.time, self.depth, self.gas.id, self.half_time_min, self.reference_value, self.fast_value))
+
+    def __str__(self):
+        lines = [
+            '{} diverges at {}s, depth {}, gas {}{}: reference {}, fast {}'.format(
+                self.field, self.time, self.depth, self.gas.id,
+                '' if self.half_time_min == None else ', {}min compartment'.format(self.half_time_min),
+                self.reference_value, self.fast_value),
+            'time, depth, gas, reference, fast:'
+        ]
+        lines.extend([str(row) for row in self.context])
+        return '\n'.join(lines)
+
+class CrossCheck():
+    def __init__(self, algorithm, engine, reference, fast, divergence) -> None:
+        self.algorithm = algorithm
+        self.engine = engine
+        self.reference = reference
+        self.fast = fast
+        self.divergence = divergence
+
+    @property
+    def passed(self):
+        return self.divergence == None
+
+    def __repr__(self) -> str:
+        return str((self.engine, self.algorithm.gf_hi, self.passed, self.divergence))
+
+    def __str__(self):
+        if self.passed:
+            return '{} matches the reference at GF {}'.format(self.engine, self.algorithm.gf_hi)
+        return '{} at GF {}: {}'.format(self.engine, self.algorithm.gf_hi, self.divergence)
+
+def first_divergence(reference, fast, ppn2_tol=1e-9, ceiling_tol=1e-6, ndl_tol=1e-3, rtol=1e-9):
+    first = None
+    for field, tol in (('ppn2', ppn2_tol), ('ceiling', ceiling_tol), ('ndl', ndl_tol)):
+        diverged = ~np.isclose(getattr(fast, field), getattr(reference, field), rtol=rtol, atol=tol)
+        if diverged.any():
+            index, compartment = np.argwhere(diverged)[0]
+            if first == None or index < first[1]:
+                first = (field, index, compartment)
+
+    # validation may only disagree where a ceiling is within tolerance of the depth
+    depths = np.array([checkpoint.depth for checkpoint in reference.dive_profile.profile])
+    borderline = np.isclose(reference.ceiling, depths[:, None], rtol=0, atol=ceiling_tol).any(axis=1)
+    diverged = (fast.validation != reference.validation) & ~borderline
+    if diverged.any():
+        index = np.argmax(diverged)
+        if first == None or index < first[1]:
+            first = ('validation', index, None)
+
+    if first == None:
+        return None
+    field, index, compartment = first
+    return Divergence(field, int(index), None if compartment == None else int(compartment), reference, fast)
+
+def cross_check(dive_checkpoints, algorithm, engine='batched', **tolerances):
+    # runs the reference per-second object model and a fast engine on the same dive, e.g. from process_diveplan.
+    # the checkpoints are copied so states cached by earlier runs (e.g. inside GetMeHome) can't leak into either
+    copies = [DiveProfileCheckpoint(time=checkpoint.time, depth=checkpoint.depth, gas=checkpoint.gas) for checkpoint in dive_checkpoints]
+    first = dive_checkpoints[0]
+    if first.time != 0 or first.depth != 0:
+        # seeded from a TissueSnapshot, rebuild the seed for this algorithm's gradient factors
+        copies[0].state = BuhlmannState(
+            algorithm.compartments, cur_checkpoint=copies[0], ppn2s=[compartment_state.ppn2 for compartment_state in first.state])
+    dive_profile = DiveProfile(checkpoints=copies)
+    fast_engine = ENGINES[engine] if isinstance(engine, str) else engine
+    # the fast engine first, so it can't see the states the reference writes into the profile
+    fast = fast_engine(dive_profile, algorithm)
+    reference = reference_engine(dive_profile, algorithm)
+    divergence = first_divergence(reference, fast, **tolerances)
+    return CrossCheck(algorithm, engine if isinstance(engine, str) else engine.__name__, reference, fast, divergence)
+
+def random_diveplan(rng: random.Random, algorithm):
+    # a random multilevel dive ending in a GetMeHome ascent. returns (dive_plan, initial_gas)
+    bottom_gas = rng.choice(RANDOM_BOTTOM_GASES)
+    max_depth = rng.randint(10, int(min(bottom_gas.mod, 50)))
+    dive_plan = [ChangeDepth(depth=max_depth, speed_mm=rng.choice([9, 18, 25]))]
+    dive_plan.append(MaintainDepth(time_min=rng.randint(1, 30)))
+    depth = max_depth
+    for level in range(rng.randint(0, 2)):
+        if depth - 1 < max(5, depth // 2):
+            break
+        # always a new depth, a ChangeDepth to the depth the diver is already at has no duration
+        depth = rng.randint(max(5, depth // 2), depth - 1)
+        dive_plan.append(ChangeDepth(depth=depth, speed_mm=rng.choice([6, 9])))
+        dive_plan.append(MaintainDepth(time_s=rng.randint(30, 15*60)))
+    available_gases = [bottom_gas, *rng.sample(deco_gases, rng.randint(0, len(deco_gases)))]
+    dive_plan.append(GetMeHome(algorithm=algorithm, available_gases=available_gases))
+    return dive_plan, bottom_gas
+
+def random_dive_checkpoints(rng: random.Random, algorithm, attempts=20):
+    # redraws until the planner accepts the plan. it rejects plans whose levels already leave the diver above a
+    # ceiling before GetMeHome starts, and ascents with no permissible gas at some stop
+    for attempt in range(attempts):
+        dive_plan, initial_gas = random_diveplan(rng, algorithm)
+        try:
+            return process_diveplan(dive_plan, initial_gas)
+        except Exception as e:
+            if not str(e).startswith(PLANNER_REJECTIONS):
+                raise
+    raise Exception("no valid random dive plan in {} attempts".format(attempts))
+
+def cross_check_random(n=10, seed=0, engine='batched', gfs=[30, 50, 70, 85, 100], **tolerances):
+    # cross checks n random dives. stops at, and returns, the first that diverges; None if they all match
+    rng = random.Random(seed)
+    for i in range(n):
+        gf = rng.choice(gfs)
+        dive_checkpoints = random_dive_checkpoints(rng, Buhlmann_Z16C(gf=gf))
+        check = cross_check(dive_checkpoints, Buhlmann_Z16C(gf=gf), engine=engine, **tolerances)
+        if not check.passed:
+            return check
+    return None
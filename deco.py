@@ -1,4 +1,5 @@
 from abc import ABC
+from collections import OrderedDict
 from typing import List, Sequence
 import numpy as np
 
@@ -39,9 +40,32 @@ class DiveProfileCheckpoint:
         self.time = time
         self.depth = depth
         self.gas = gas
+        self.__state_source__ = None
         self.state = state
         self.validation = validation
 
+    @property
+    def state(self):
+        if self.__state__ == None and self.__state_source__ != None:
+            # state was dropped by the algorithm's retention policy, recompute it from the nearest snapshot
+            algorithm, dive_profile, index = self.__state_source__
+            return algorithm.__rematerialize_state__(dive_profile, index)
+        return self.__state__
+
+    @state.setter
+    def state(self, state):
+        self.__state__ = state
+        self.__state_source__ = None
+
+    @property
+    def has_state(self):
+        # True if a state is stored or can be rematerialized, without rematerializing it
+        return self.__state__ != None or self.__state_source__ != None
+
+    def drop_state(self, algorithm, dive_profile, index):
+        self.__state__ = None
+        self.__state_source__ = (algorithm, dive_profile, index)
+
     def __repr__(self) -> str:
         return str((self.time, self.depth, self.state, self.validation))
     
@@ -54,8 +78,10 @@ class DiveProfile:
         self.explode_checkpoints(checkpoints)
 
     def explode_checkpoints(self, checkpoints):
-        assert checkpoints[0].time == 0
-        assert checkpoints[0].depth == 0
+        if not checkpoints[0].has_state:
+            # a profile either starts at the surface, or from a seeded tissue state (see TissueSnapshot)
+            assert checkpoints[0].time == 0
+            assert checkpoints[0].depth == 0
         for i in range(len(checkpoints)-1):
             prev_ckpt = checkpoints[i]
             next_ckpt = checkpoints[i+1]
@@ -86,6 +112,9 @@ class DiveProfile:
             else:
                 prop_prev = (time_to_process - prev_checkpoint.time) / (next_checkpoint.time - prev_checkpoint.time)
                 interpolated_depth = next_checkpoint.depth * prop_prev + prev_checkpoint.depth * (1-prop_prev)
+                if prev_checkpoint.depth == next_checkpoint.depth:
+                    # a stop: rounding would put e.g. a 6m oxygen stop a hair below its MOD
+                    interpolated_depth = next_checkpoint.depth
                 gas=prev_checkpoint.gas
                 new_checkpoint = DiveProfileCheckpoint(time=time_to_process, depth=interpolated_depth, gas=gas)
                 self.profile.append(new_checkpoint)
@@ -111,6 +140,21 @@ class DiveAlgorithm(ABC):
         self.__calculate_states__(dive_profile)
         return self.__validate_states__(dive_profile)
 
+    def __tissue_key__(self):
+        # algorithms returning equal keys share tissue loading, so process_algorithms only calculates it once
+        pass
+
+    def __calculate_tissues__(self, dive_profile: DiveProfile):
+        # returns the tissue loading at each entry in the dive profile, without writing to the profile
+        pass
+
+    def __results_from_tissues__(self, dive_profile: DiveProfile, tissues):
+        # returns the DiveResults of this algorithm, given tissue loading shared with other algorithms
+        pass
+
+    def results(self, dive_profile: DiveProfile):
+        return process_algorithms(dive_profile, [self])[self]
+
 class BuhlmannCompartment:
     def __init__(self, gf_hi, surfacing_m_value, m_value_slope, half_time_min) -> None:
         self.gf_hi = gf_hi  # TODO refactor again
@@ -129,11 +173,20 @@ class BuhlmannCompartmentState:
         self,
         compartment: BuhlmannCompartment,
         current_checkpoint: DiveProfileCheckpoint=None,
-        previous_checkpoint: DiveProfileCheckpoint=None
+        previous_checkpoint: DiveProfileCheckpoint=None,
+        ppn2=None,
+        ceiling=None,
+        ndl=None
     ) -> None:
         self.compartment = compartment
         self.ndl=None
-        if previous_checkpoint == None:
+        if previous_checkpoint == None and ppn2 != None:
+            # seeded from a snapshot or an archive rather than computed from the previous checkpoint
+            inhaled_ppn2 = (1+(current_checkpoint.depth)/10 - WV_PRESSURE) * current_checkpoint.gas.nitrogen
+            self.ppn2 = ppn2
+            self.ceiling = self.calculate_ceiling(self.ppn2, compartment) if ceiling == None else ceiling
+            self.ndl = self.calculate_ndl(self.ppn2, compartment, inhaled_ppn2) if ndl == None else ndl
+        elif previous_checkpoint == None:
             self.ppn2 = (1 - WV_PRESSURE) * SURFACE_NITROGEN
             self.ceiling = self.calculate_ceiling(self.ppn2, compartment)
             self.ndl = 99
@@ -265,8 +318,17 @@ class BuhlmannCompartmentState:
 
 class BuhlmannState(Sequence):
     # this will behave as a list of BuhlmannCompartmentState
-    def __init__(self, compartments, prev_checkpoint: DiveProfileCheckpoint = None, cur_checkpoint: DiveProfileCheckpoint = None) -> None:
-        if prev_checkpoint == None:
+    def __init__(self, compartments, prev_checkpoint: DiveProfileCheckpoint = None, cur_checkpoint: DiveProfileCheckpoint = None, ppn2s=None, ceilings=None, ndls=None) -> None:
+        if prev_checkpoint == None and ppn2s != None:
+            ceilings = [None] * len(compartments) if ceilings == None else ceilings
+            ndls = [None] * len(compartments) if ndls == None else ndls
+            state = [BuhlmannCompartmentState(
+                compartment,
+                current_checkpoint=cur_checkpoint,
+                ppn2=ppn2,
+                ceiling=ceiling,
+                ndl=ndl) for compartment, ppn2, ceiling, ndl in zip(compartments, ppn2s, ceilings, ndls)]
+        elif prev_checkpoint == None:
             state = [BuhlmannCompartmentState(compartment) for compartment in compartments]
         else:
             state = [BuhlmannCompartmentState(
@@ -288,10 +350,15 @@ class BuhlmannState(Sequence):
         return str(self.__state__)
 
 class Buhlmann_Z16C(DiveAlgorithm):
-    def __init__(self, gf=100) -> None:
+    def __init__(self, gf=100, snapshot_every_s=None, rematerialized_windows=8) -> None:
         # https://www.shearwater.com/wp-content/uploads/2019/05/understanding_m-values.pdf
         self.gf_hi=gf
         self.gf_lo=gf  # not used, much harder to implement
+        # retention policy: None keeps every per-second state. Otherwise only every snapshot_every_s seconds and
+        # segment boundaries keep a full state, others are recomputed on demand and kept in a small LRU of windows
+        self.snapshot_every_s = snapshot_every_s
+        self.rematerialized_windows = rematerialized_windows
+        self.__windows__ = OrderedDict()
         self.compartments = [
             BuhlmannCompartment(gf_hi=gf,surfacing_m_value=29.65704, m_value_slope = 1.7928,half_time_min=5),
             BuhlmannCompartment(gf_hi=gf,surfacing_m_value=25.35936, m_value_slope = 1.5352,half_time_min=8),
@@ -312,31 +379,245 @@ class Buhlmann_Z16C(DiveAlgorithm):
         ]
 
     def __calculate_states__(self, dive_profile: DiveProfile):
+        if self.snapshot_every_s:
+            segment_boundaries = set(id(checkpoint) for checkpoint in dive_profile.__checkpoints__)
         for i in range(len(dive_profile.profile)):
             cur_checkpoint = dive_profile.profile[i]  # to update
-            if not cur_checkpoint.state:
+            if not cur_checkpoint.has_state:
                 if i == 0:
                     cur_checkpoint.state = BuhlmannState(self.compartments)
                 else:
                     prev_checkpoint = dive_profile.profile[i-1]
                     cur_checkpoint.state = BuhlmannState(self.compartments, prev_checkpoint, cur_checkpoint)
+            if self.snapshot_every_s:
+                # validate while the state is still stored, then only keep it if it's a snapshot or the next
+                # checkpoint needs it, so at most one state beyond the snapshots is held at any time
+                self.__validate_checkpoint__(cur_checkpoint)
+                if i >= 2:
+                    self.__retain_state__(dive_profile, i-1, segment_boundaries)
+
+    def __validate_checkpoint__(self, checkpoint: DiveProfileCheckpoint):
+        if not checkpoint.validation:
+            ceilings_valid = all([compartment.ceiling <= checkpoint.depth for compartment in checkpoint.state])
+            mod_valid = checkpoint.depth <= checkpoint.gas.mod
+            min_od_valid = checkpoint.depth >= checkpoint.gas.min_od
+            checkpoint.validation = ceilings_valid and mod_valid and min_od_valid
 
     def __validate_states__(self, dive_profile: DiveProfile) -> bool:
         for checkpoint in dive_profile:
-            if not checkpoint.validation:
-                ceilings_valid = all([compartment.ceiling <= checkpoint.depth for compartment in checkpoint.state])
-                mod_valid = checkpoint.depth <= checkpoint.gas.mod
-                min_od_valid = checkpoint.depth >= checkpoint.gas.min_od
-                checkpoint.validation = ceilings_valid and mod_valid and min_od_valid
+            self.__validate_checkpoint__(checkpoint)
         return all([checkpoint.validation for checkpoint in dive_profile])
 
-def graph_buhlmann_dive_profile(dive: DiveProfile, buhlmann: Buhlmann_Z16C, simple=False):
-    times = [checkpoint.time/60 for checkpoint in dive.profile]
-    gas_ids = list(set([checkpoint.gas.id for checkpoint in dive.profile]))
+    def __tissue_key__(self):
+        # ppN2 only depends on the half times, so every gradient factor can share it
+        return ('buhlmann', tuple([compartment.half_time_min for compartment in self.compartments]))
+
+    def __calculate_tissues__(self, dive_profile: DiveProfile):
+        # the same sums as BuhlmannCompartmentState, one row per entry in the dive profile and one column per compartment
+        half_times = np.array([compartment.half_time_min for compartment in self.compartments])
+        times = np.array([checkpoint.time for checkpoint in dive_profile.profile], dtype=float)
+        inhaled_ppn2 = inhaled_ppn2_by_checkpoint(dive_profile)
+        time_spent = np.diff(times, prepend=times[0])
+        update = 1 - 2 ** (-(time_spent[:, None] / 60) / half_times[None, :])
+        ppn2 = np.zeros((len(dive_profile.profile), len(self.compartments)))
+        first = dive_profile.profile[0]
+        if first.has_state:
+            ppn2[0] = [compartment_state.ppn2 for compartment_state in first.state]
+        else:
+            ppn2[0] = (1 - WV_PRESSURE) * SURFACE_NITROGEN
+        for i in range(1, len(ppn2)):
+            ppn2[i] = ppn2[i-1] + (inhaled_ppn2[i] - ppn2[i-1]) * update[i]
+        return ppn2
+
+    def adjusted_m_values(self):
+        # gradient factor adjusted surfacing m-values (bar) and slopes, one per compartment
+        surfacing_m_value_bar = np.array([compartment.surfacing_m_value for compartment in self.compartments]) / 10
+        m_value_slope = np.array([compartment.m_value_slope for compartment in self.compartments])
+        gf_prop = np.array([compartment.gf_hi for compartment in self.compartments]) / 100
+        adjusted_m_value_slope = m_value_slope*(gf_prop) + (1-gf_prop)
+        adjusted_surfacing_m_value_bar = (surfacing_m_value_bar - 1) * gf_prop + 1
+        return adjusted_surfacing_m_value_bar, adjusted_m_value_slope
+
+    def ceilings(self, ppn2):
+        # vectorised BuhlmannCompartmentState.calculate_ceiling, for any array of ppN2 with compartments last
+        adjusted_surfacing_m_value_bar, adjusted_m_value_slope = self.adjusted_m_values()
+        ceiling_bar = (ppn2 - adjusted_surfacing_m_value_bar) / adjusted_m_value_slope - 1
+        ceiling = (ceiling_bar + 1) * 10
+        return np.where(ceiling < 0, 0, ceiling)
+
+    def __results_from_tissues__(self, dive_profile: DiveProfile, ppn2):
+        half_times = np.array([compartment.half_time_min for compartment in self.compartments])
+        adjusted_surfacing_m_value_bar, adjusted_m_value_slope = self.adjusted_m_values()
+        ceiling = self.ceilings(ppn2)
+
+        inhaled_ppn2 = inhaled_ppn2_by_checkpoint(dive_profile)[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = (inhaled_ppn2 - adjusted_surfacing_m_value_bar) / (inhaled_ppn2 - ppn2)
+            ndl = (-half_times/(np.log(2)))*np.log(ratio)
+        # equilibrium, off gassing, or on gassing but never hitting the m-value: NDL infinite
+        ndl = np.where((inhaled_ppn2 > ppn2) & (ratio > 0), ndl, 999)
+        first = dive_profile.profile[0]
+        if first.time == 0 and first.depth == 0:
+            # a surface start, like BuhlmannCompartmentState, even if an earlier process() cached its state. a start
+            # seeded from a TissueSnapshot keeps this algorithm's own NDLs from the formula, rather than ones
+            # computed with whichever gradient factors seeded it
+            ndl[0] = 99
+
+        depths = np.array([checkpoint.depth for checkpoint in dive_profile.profile], dtype=float)
+        mods = np.array([checkpoint.gas.mod for checkpoint in dive_profile.profile])
+        min_ods = np.array([checkpoint.gas.min_od for checkpoint in dive_profile.profile])
+        validation = (ceiling <= depths[:, None]).all(axis=1) & (depths <= mods) & (depths >= min_ods)
+        return DiveResults(self, dive_profile, ppn2, ceiling, ndl, validation)
+
+    def __retain_state__(self, dive_profile: DiveProfile, index, segment_boundaries):
+        # the first and last states, snapshots and segment boundaries are kept, the rest are recomputed on demand
+        checkpoint = dive_profile.profile[index]
+        if index == 0 or index == len(dive_profile.profile) - 1 or checkpoint.__state__ == None:
+            return None
+        if checkpoint.time % self.snapshot_every_s == 0 or id(checkpoint) in segment_boundaries:
+            return None
+        checkpoint.drop_state(self, dive_profile, index)
+
+    def __rematerialize_state__(self, dive_profile: DiveProfile, index):
+        checkpoint = dive_profile.profile[index]
+        snapshot_index = index
+        while dive_profile.profile[snapshot_index].__state__ == None:
+            snapshot_index = snapshot_index - 1
+        snapshot = dive_profile.profile[snapshot_index]
+        window = self.__windows__.get(snapshot)
+        if window == None or checkpoint not in window:
+            # recompute every dropped state up to the next snapshot
+            window = {}
+            prev_checkpoint = snapshot
+            i = snapshot_index + 1
+            while i < len(dive_profile.profile) and dive_profile.profile[i].__state__ == None:
+                cur_checkpoint = dive_profile.profile[i]
+                state = BuhlmannState(self.compartments, prev_checkpoint, cur_checkpoint)
+                window[cur_checkpoint] = state
+                # stand-in for the previous checkpoint, so its state isn't rematerialized again
+                prev_checkpoint = DiveProfileCheckpoint(
+                    time=cur_checkpoint.time, depth=cur_checkpoint.depth, gas=cur_checkpoint.gas, state=state)
+                i = i + 1
+            self.__windows__[snapshot] = window
+            while len(self.__windows__) > self.rematerialized_windows:
+                self.__windows__.popitem(last=False)
+        self.__windows__.move_to_end(snapshot)
+        return window[checkpoint]
+
+def inhaled_ppn2_by_checkpoint(dive_profile: DiveProfile):
+    return np.array([
+        (1+(checkpoint.depth)/10 - WV_PRESSURE) * checkpoint.gas.nitrogen for checkpoint in dive_profile.profile])
+
+class DiveResults:
+    # one algorithm's results for one dive profile, kept out of the profile so it can carry results for many algorithms.
+    # arrays have one row per entry in the dive profile, and one column per compartment
+    def __init__(self, algorithm: DiveAlgorithm, dive_profile: DiveProfile, ppn2, ceiling, ndl, validation) -> None:
+        self.algorithm = algorithm
+        self.dive_profile = dive_profile
+        self.ppn2 = ppn2
+        self.ceiling = ceiling
+        self.ndl = ndl
+        self.validation = validation
+
+    @property
+    def valid(self):
+        return bool(self.validation.all())
+
+    @property
+    def first_invalid_time(self):
+        if self.valid:
+            return None
+        return self.dive_profile.profile[int(np.argmin(self.validation))].time
+
+    def __repr__(self) -> str:
+        return str((self.algorithm, self.valid, self.first_invalid_time))
+
+    def __str__(self):
+        return str((self.algorithm, self.valid, self.first_invalid_time))
+
+def results_from_checkpoints(algorithm: DiveAlgorithm, dive_profile: DiveProfile):
+    # DiveResults for the states and validations an algorithm wrote into the profile with process()
+    # states dropped by a retention policy are rematerialized in order, so each window is only recomputed once and
+    # only a few windows are held at a time
+    validation = np.array([bool(checkpoint.validation) for checkpoint in dive_profile.profile])
+    n_compartments = len(dive_profile.profile[0].state)
+    ppn2 = np.zeros((len(dive_profile.profile), n_compartments))
+    ceiling = np.zeros((len(dive_profile.profile), n_compartments))
+    ndl = np.zeros((len(dive_profile.profile), n_compartments))
+    for i, checkpoint in enumerate(dive_profile.profile):
+        state = checkpoint.state
+        ppn2[i] = [compartment.ppn2 for compartment in state]
+        ceiling[i] = [compartment.ceiling for compartment in state]
+        ndl[i] = [compartment.ndl for compartment in state]
+    return DiveResults(algorithm, dive_profile, ppn2, ceiling, ndl, validation)
+
+def process_algorithms(dive_profile: DiveProfile, algorithms: List[DiveAlgorithm]):
+    # evaluates several algorithms over one shared dive profile, without writing results into its checkpoints.
+    # tissue loading is calculated once per tissue model, then each algorithm only adds its own limits
+    tissues_by_key = {}
+    results = {}
+    for algorithm in algorithms:
+        key = algorithm.__tissue_key__()
+        if key not in tissues_by_key:
+            tissues_by_key[key] = algorithm.__calculate_tissues__(dive_profile)
+        results[algorithm] = algorithm.__results_from_tissues__(dive_profile, tissues_by_key[key])
+    return results
+
+class TissueSnapshot:
+    # frozen copy of the tissue loading at one point of a processed dive, which can seed new dive profiles
+    # ppN2 does not depend on gradient factors, so a snapshot can seed any Buhlmann_Z16C configuration
+    def __init__(self, dive_profile: DiveProfile, time=None) -> None:
+        if time == None:
+            checkpoint = dive_profile.profile[-1]
+        else:
+            matches = [checkpoint for checkpoint in dive_profile.profile if checkpoint.time == time]
+            if not matches:
+                raise Exception("no checkpoint at time {} in dive profile".format(time))
+            checkpoint = matches[0]
+        if not checkpoint.state:
+            raise Exception("dive profile must be processed by an algorithm before taking a snapshot")
+        self.time = int(checkpoint.time)
+        self.depth = checkpoint.depth
+        self.gas = checkpoint.gas
+        self.ppn2s = [compartment_state.ppn2 for compartment_state in checkpoint.state]
+
+    def seed_checkpoint(self, algorithm: Buhlmann_Z16C) -> DiveProfileCheckpoint:
+        # a fresh checkpoint per call: states and validations are cached on checkpoints, so forks must not share them
+        checkpoint = DiveProfileCheckpoint(time=self.time, depth=self.depth, gas=self.gas)
+        checkpoint.state = BuhlmannState(algorithm.compartments, cur_checkpoint=checkpoint, ppn2s=self.ppn2s)
+        return checkpoint
+
+    def __repr__(self) -> str:
+        return str((self.time, self.depth, self.gas.id, self.ppn2s))
+
+    def __str__(self):
+        return str((self.time, self.depth, self.gas.id, self.ppn2s))
+
+def graph_buhlmann_dive_profile(dive: DiveProfile, buhlmann: Buhlmann_Z16C, simple=False, results: DiveResults=None, provisional=False, sample_every_s=None, batched=False):
+    if results == None and batched:
+        # tissues from the batched path instead of the states in the profile, e.g. when a retention policy dropped
+        # most of them. the validations are still the ones process() wrote
+        results = buhlmann.results(dive)
+        results.validation = np.array([bool(checkpoint.validation) for checkpoint in dive.profile])
+    if results == None:
+        results = results_from_checkpoints(buhlmann, dive)
+    checkpoints_not_allowed = [checkpoint for checkpoint, valid in zip(dive.profile, results.validation.tolist()) if not valid]
+    profile = dive.profile
+    ceilings = results.ceiling
+    ndls = results.ndl
+    if sample_every_s:
+        # only plot every sample_every_s seconds, e.g. for a quick provisional graph. the verdict still uses every second
+        kept = [i for i, checkpoint in enumerate(profile) if checkpoint.time % sample_every_s == 0 or i == len(profile) - 1]
+        profile = [profile[i] for i in kept]
+        ceilings = ceilings[kept]
+        ndls = ndls[kept]
+    times = [checkpoint.time/60 for checkpoint in profile]
+    ceilings = ceilings.tolist()
+    ndls = ndls.tolist()
+    gas_ids = list(set([checkpoint.gas.id for checkpoint in profile]))
     gas_ids.sort(key=lambda x: int(x.split(' ')[0].split('/')[0]))
-    depths_by_gas = [(gas_id, [(-checkpoint.depth, checkpoint.time) for checkpoint in dive.profile if checkpoint.gas.id == gas_id]) for gas_id in gas_ids]
+    depths_by_gas = [(gas_id, [(-checkpoint.depth, checkpoint.time) for checkpoint in profile if checkpoint.gas.id == gas_id]) for gas_id in gas_ids]
     depths_by_gas.sort(key=lambda g: g[1][0][1])
-    checkpoints_not_allowed = [checkpoint for checkpoint in dive.profile if not checkpoint.validation]
     validation = len(checkpoints_not_allowed) == 0
     min_second_not_allowed = None if validation else int(checkpoints_not_allowed[0].time)
     min_minute_not_allowed = None if validation else int(min_second_not_allowed//60)
@@ -358,21 +639,19 @@ def graph_buhlmann_dive_profile(dive: DiveProfile, buhlmann: Buhlmann_Z16C, simp
         plt.plot(gas_times, gas_depths, label='depth, {}'.format(gas_id))
 
     for i in range(len(buhlmann.compartments)):
-        compartment_ceiling = [-checkpoint.state[i].ceiling for checkpoint in dive.profile]
+        compartment_ceiling = [-ceiling[i] for ceiling in ceilings]
         plt.plot(times, compartment_ceiling, label=str(buhlmann.compartments[i].half_time_min) + 'min')
         # compartment_ppn2 = [checkpoint.state[i].ppn2 for checkpoint in dive.profile]
         # plt.plot(times, compartment_ppn2, label=str(buhlmann.compartments[i].half_time_min) + 'min')
     
 
     plot_ndl = False
-    for checkpoint in dive.profile:
+    for checkpoint, checkpoint_ceilings, checkpoint_ndls in zip(profile, ceilings, ndls):
         mark_ndl_every_mins = 2.5 if max(times)<80 else 5
         if checkpoint.time % (mark_ndl_every_mins*60) == 0:
-            ndls = [int(compartment.ndl) for compartment in checkpoint.state]
-            # print(ndls)
-            ndl = min(ndls)
+            ndl = min([int(compartment_ndl) for compartment_ndl in checkpoint_ndls])
             # print(ndl)
-            ceiling = max([compartment.ceiling for compartment in checkpoint.state])
+            ceiling = max(checkpoint_ceilings)
             if ndl >= 0 and ndl < 100 and checkpoint.time > 0 and not ceiling:
                 plt.annotate(ndl,
                         xy=(checkpoint.time/60, 0), xycoords='data',
@@ -407,6 +686,8 @@ def graph_buhlmann_dive_profile(dive: DiveProfile, buhlmann: Buhlmann_Z16C, simp
         + 'Dive is {} [DO NOT TRUST THIS PLANNER!]'.format(
             'permissible, {} min'.format(str(int(max(times)))) if validation else 'not permissible from minute {}'.format(min_minute_not_allowed)
             )
+    if provisional:
+        title = '[PROVISIONAL, REFINING] ' + title
     plt.title(title)
 
     if not simple:
@@ -0,0 +1,276 @@
+import math
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from deco import DiveProfile, DiveProfileCheckpoint, TissueSnapshot, Buhlmann_Z16C, WV_PRESSURE
+
+MAX_RUNTIME_S = 60*60*10  # same cap as GetMeHome
+# MODs are floats, so e.g. an oxygen MOD a hair under 6m must still give a 6m switch depth
+DEPTH_TOLERANCE_M = 1e-6
+
+CEILING_VIOLATED = 'ceiling'
+GAS_LIMIT_VIOLATED = 'gas'
+
+class AscentOptions():
+    # the search space for optimise_ascent. every combination of ascent rate, last stop and switch pause is
+    # searched on its own worker, and within it every deco gas can be switched to at one of switch_depth_offsets
+    # metres shallower than its first usable stop, or not at all
+    def __init__(
+        self,
+        deco_gases=[],
+        ascent_rates_mm=[9],
+        last_stops=[3, 6],
+        switch_pauses_s=[0, 60],
+        switch_depth_offsets=[0, 3, 6],
+        stop_step_s=60,
+        sac_l_min=20
+    ) -> None:
+        self.deco_gases = deco_gases
+        self.ascent_rates_mm = ascent_rates_mm
+        self.last_stops = last_stops
+        self.switch_pauses_s = switch_pauses_s
+        self.switch_depth_offsets = switch_depth_offsets
+        self.stop_step_s = stop_step_s
+        self.sac_l_min = sac_l_min
+
+class AscentPlan():
+    def __init__(self, checkpoints, bottom_gas, ascent_rate_mm, last_stop, switch_pause_s, switches, gas_used_l) -> None:
+        self.checkpoints = checkpoints
+        self.bottom_gas = bottom_gas
+        self.ascent_rate_mm = ascent_rate_mm
+        self.last_stop = last_stop
+        self.switch_pause_s = switch_pause_s
+        self.switches = switches  # list of (gas id, depth)
+        self.gas_used_l = gas_used_l  # by gas id
+        self.valid = None  # set once the plan is checked against the full algorithm
+
+    @property
+    def runtime_s(self):
+        return self.checkpoints[-1].time
+
+    @property
+    def ascent_gas_l(self):
+        # everything breathed from the snapshot to the surface, whichever gas it came from. counting only the deco
+        # gases would make never switching the best plan
+        return sum(self.gas_used_l.values())
+
+    def score(self, objective):
+        if objective == 'runtime':
+            return (self.runtime_s, self.ascent_gas_l)
+        if objective == 'ascent_gas':
+            return (self.ascent_gas_l, self.runtime_s)
+        raise Exception("unknown objective {}".format(objective))
+
+    def __repr__(self) -> str:
+        return str((self.runtime_s / 60, round(self.ascent_gas_l), self.ascent_rate_mm, self.last_stop, self.switch_pause_s, self.switches, self.valid))
+
+    def __str__(self):
+        return str((self.runtime_s / 60, round(self.ascent_gas_l), self.ascent_rate_mm, self.last_stop, self.switch_pause_s, self.switches, self.valid))
+
+class AscentNode():
+    # a partial ascent: the last per-second checkpoint, its ppN2 by compartment and the schedule so far
+    def __init__(self, checkpoint, ppn2, checkpoints, gas_used_l, switches) -> None:
+        self.checkpoint = checkpoint
+        self.ppn2 = ppn2
+        self.checkpoints = checkpoints
+        self.gas_used_l = gas_used_l
+        self.switches = switches
+
+class AscentSearch():
+    # branch and bound over gas switch depths, for one ascent rate, last stop and switch pause
+    def __init__(self, algorithm, options, ascent_rate_mm, last_stop, switch_pause_s, objective) -> None:
+        self.algorithm = algorithm
+        self.options = options
+        self.ascent_rate_mm = ascent_rate_mm
+        self.last_stop = last_stop
+        self.switch_pause_s = switch_pause_s
+        self.objective = objective
+        self.bottom_gas = None
+        self.best = None
+        self.half_times = np.array([compartment.half_time_min for compartment in algorithm.compartments])
+        # fraction of the ppN2 gradient left after one second, by compartment
+        self.decay = 2 ** (-(1 / 60) / self.half_times)
+        self.surfacing_m_value_bar = algorithm.adjusted_m_values()[0]
+
+    def extend(self, node, endpoint):
+        # steps second by second to the endpoint, exactly like DiveProfile.add_checkpoint explodes a segment, but on
+        # ppN2 arrays rather than a BuhlmannState per second
+        prev = node.checkpoint
+        times = np.arange(int(prev.time) + 1, int(endpoint.time) + 1)
+        prop_prev = (times - prev.time) / (endpoint.time - prev.time)
+        depths = endpoint.depth * prop_prev + prev.depth * (1-prop_prev)
+        depths[-1] = endpoint.depth
+        if prev.depth == endpoint.depth:
+            depths[:] = endpoint.depth
+        nitrogen = np.full(len(times), prev.gas.nitrogen)
+        nitrogen[-1] = endpoint.gas.nitrogen
+        inhaled_ppn2 = (1 + depths/10 - WV_PRESSURE) * nitrogen
+        if (inhaled_ppn2 == inhaled_ppn2[0]).all():
+            # a stop: every second decays by the same factor
+            decay = self.decay[None, :] ** np.arange(1, len(times) + 1)[:, None]
+            ppn2 = inhaled_ppn2[0] + (node.ppn2 - inhaled_ppn2[0]) * decay
+        else:
+            ppn2 = np.zeros((len(times), len(node.ppn2)))
+            prev_ppn2 = node.ppn2
+            for i in range(len(times)):
+                prev_ppn2 = prev_ppn2 + (inhaled_ppn2[i] - prev_ppn2) * (1 - self.decay)
+                ppn2[i] = prev_ppn2
+
+        gas_violated = np.full(len(times), depths[-1] > endpoint.gas.mod or depths[-1] < endpoint.gas.min_od)
+        gas_violated[:-1] = (depths[:-1] > prev.gas.mod) | (depths[:-1] < prev.gas.min_od)
+        ceiling_violated = (self.algorithm.ceilings(ppn2) > depths[:, None]).any(axis=1)
+        if gas_violated.any() or ceiling_violated.any():
+            first_gas = np.argmax(gas_violated) if gas_violated.any() else len(times)
+            first_ceiling = np.argmax(ceiling_violated) if ceiling_violated.any() else len(times)
+            return None, GAS_LIMIT_VIOLATED if first_gas <= first_ceiling else CEILING_VIOLATED
+
+        gas_used_l = dict(node.gas_used_l)
+        litres = self.options.sac_l_min / 60 * (1 + depths/10)
+        gas_used_l[prev.gas.id] = gas_used_l.get(prev.gas.id, 0) + float(litres[:-1].sum())
+        gas_used_l[endpoint.gas.id] = gas_used_l.get(endpoint.gas.id, 0) + float(litres[-1])
+        checkpoints = list(node.checkpoints)
+        if len(checkpoints) >= 2 and checkpoints[-1].depth == checkpoints[-2].depth == endpoint.depth \
+                and checkpoints[-1].gas == checkpoints[-2].gas == endpoint.gas:
+            # extending a stop, no need for another checkpoint
+            checkpoints.pop()
+        checkpoint = DiveProfileCheckpoint(time=endpoint.time, depth=endpoint.depth, gas=endpoint.gas)
+        checkpoints.append(checkpoint)
+        return AscentNode(checkpoint, ppn2[-1], checkpoints, gas_used_l, node.switches), None
+
+    def next_stop(self, depth):
+        if depth % 3 == 0:
+            stop = depth - 3
+        else:
+            stop = depth // 3 * 3
+        if stop < self.last_stop:
+            return 0
+        return stop
+
+    def ascend_to_next_stop(self, node):
+        # ascend if the ceiling allows, otherwise wait at the current depth. None if the ascent is impossible
+        while True:
+            cur = node.checkpoint
+            stop = self.next_stop(cur.depth)
+            duration = max(1, math.ceil(abs(cur.depth - stop) / self.ascent_rate_mm * 60))
+            endpoint = DiveProfileCheckpoint(time=int(cur.time) + duration, depth=stop, gas=cur.gas)
+            next_node, reason = self.extend(node, endpoint)
+            if next_node:
+                return next_node
+            if reason == GAS_LIMIT_VIOLATED:
+                return None
+            endpoint = DiveProfileCheckpoint(time=int(cur.time) + self.options.stop_step_s, depth=cur.depth, gas=cur.gas)
+            node, reason = self.extend(node, endpoint)
+            if not node or node.checkpoint.time > MAX_RUNTIME_S:
+                return None
+
+    def switch_gas(self, node, gas):
+        cur = node.checkpoint
+        endpoint = DiveProfileCheckpoint(time=int(cur.time) + 1, depth=cur.depth, gas=gas)
+        node, reason = self.extend(node, endpoint)
+        if node and self.switch_pause_s:
+            endpoint = DiveProfileCheckpoint(time=int(cur.time) + 1 + self.switch_pause_s, depth=cur.depth, gas=gas)
+            node, reason = self.extend(node, endpoint)
+        if node:
+            node.switches = [*node.switches, (gas.id, cur.depth)]
+        return node
+
+    def lower_bound(self, node, gases):
+        # no schedule can offgas faster than breathing the leanest gas left, nor ascend faster than the rate. the
+        # diver stays at the last stop or deeper until the final ascent, so offgassing is bounded by the leanest gas
+        # there, and the final ascent only needs to start from tissues the surface could still clear in its duration
+        cur = node.checkpoint
+        min_nitrogen = min([gas.nitrogen for gas in gases])
+        last_stop = min(cur.depth, self.last_stop)
+        final_ascent_min = last_stop / self.ascent_rate_mm
+        surface_ppn2 = (1 - WV_PRESSURE) * min_nitrogen
+        stop_ppn2 = (1 + last_stop/10 - WV_PRESSURE) * min_nitrogen
+        leave_stop_ppn2 = surface_ppn2 + (self.surfacing_m_value_bar - surface_ppn2) * 2 ** (final_ascent_min / self.half_times)
+        offgassing = node.ppn2 > leave_stop_ppn2
+        if (leave_stop_ppn2[offgassing] <= stop_ppn2).any():
+            return (math.inf, 0)
+        offgas_min = 0
+        if offgassing.any():
+            offgas_min = final_ascent_min + (self.half_times[offgassing] * np.log2(
+                (node.ppn2[offgassing] - stop_ppn2) / (leave_stop_ppn2[offgassing] - stop_ppn2))).max()
+        remaining_s = 60 * max(offgas_min, cur.depth / self.ascent_rate_mm)
+        if self.objective == 'ascent_gas':
+            # breathing at least surface pressure for the rest of the ascent
+            return (sum(node.gas_used_l.values()) + self.options.sac_l_min / 60 * remaining_s, 0)
+        return (cur.time + remaining_s, 0)
+
+    def pruned(self, node, gases):
+        return self.best != None and self.lower_bound(node, gases) >= self.best.score(self.objective)
+
+    def search(self, node, gases):
+        # gases[0] is being breathed, gases[1:] are the deco gases still to switch to, deepest first
+        if self.pruned(node, gases):
+            return None
+        if len(gases) == 1:
+            while node and node.checkpoint.depth > 0:
+                node = self.ascend_to_next_stop(node)
+            if node:
+                self.finish(node)
+            return None
+
+        gas, remaining = gases[1], gases[2:]
+        first_stop = math.floor(min(gas.mod, node.checkpoint.depth) / 3 + DEPTH_TOLERANCE_M) * 3
+        switch_depths = set([first_stop - offset for offset in self.options.switch_depth_offsets])
+        switch_depths = [depth for depth in switch_depths if depth >= max(self.last_stop, gas.min_od) and depth > 0]
+        stop_node = node
+        while stop_node and switch_depths:
+            depth = stop_node.checkpoint.depth
+            matches = [switch_depth for switch_depth in switch_depths if abs(depth - switch_depth) <= DEPTH_TOLERANCE_M]
+            if matches:
+                switch_depths.remove(matches[0])
+                switched_node = self.switch_gas(stop_node, gas)
+                if switched_node:
+                    self.search(switched_node, [gas, *remaining])
+            if not switch_depths or depth <= 0 or self.pruned(stop_node, gases):
+                break
+            stop_node = self.ascend_to_next_stop(stop_node)
+        # don't switch to this gas at all
+        self.search(node, [gases[0], *remaining])
+
+    def finish(self, node):
+        plan = AscentPlan(
+            checkpoints=node.checkpoints,
+            bottom_gas=self.bottom_gas,
+            ascent_rate_mm=self.ascent_rate_mm,
+            last_stop=self.last_stop,
+            switch_pause_s=self.switch_pause_s,
+            switches=node.switches,
+            gas_used_l=node.gas_used_l)
+        if self.best == None or plan.score(self.objective) < self.best.score(self.objective):
+            self.best = plan
+
+    def run(self, snapshot: TissueSnapshot):
+        self.bottom_gas = snapshot.gas
+        seed = DiveProfileCheckpoint(time=snapshot.time, depth=snapshot.depth, gas=snapshot.gas)
+        node = AscentNode(seed, np.array(snapshot.ppn2s), [], {}, [])
+        deco_gases = sorted(self.options.deco_gases, key=lambda gas: gas.mod, reverse=True)
+        self.search(node, [snapshot.gas, *deco_gases])
+        return self.best
+
+def search_ascent(snapshot, algorithm, options, ascent_rate_mm, last_stop, switch_pause_s, objective):
+    return AscentSearch(algorithm, options, ascent_rate_mm, last_stop, switch_pause_s, objective).run(snapshot)
+
+def optimise_ascent(snapshot: TissueSnapshot, algorithm: Buhlmann_Z16C, options: AscentOptions, objective='runtime', executor=None):
+    # best ascent from the snapshot for the objective ('runtime' or 'ascent_gas'), checked against the full algorithm.
+    # None if no schedule in the search space is valid
+    if executor == None:
+        with ProcessPoolExecutor() as pool:
+            return optimise_ascent(snapshot, algorithm, options, objective=objective, executor=pool)
+    futures = [
+        executor.submit(search_ascent, snapshot, algorithm, options, ascent_rate_mm, last_stop, switch_pause_s, objective)
+        for ascent_rate_mm, last_stop, switch_pause_s
+        in product(options.ascent_rates_mm, options.last_stops, options.switch_pauses_s)
+    ]
+    plans = [future.result() for future in futures]
+    plans = [plan for plan in plans if plan]
+    plans.sort(key=lambda plan: plan.score(objective))
+    for plan in plans:
+        dive = DiveProfile(checkpoints=[snapshot.seed_checkpoint(algorithm), *plan.checkpoints])
+        plan.valid = algorithm.process(dive)
+        if plan.valid:
+            return plan
+    return None
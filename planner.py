@@ -1,4 +1,7 @@
-from deco import DiveProfile, Buhlmann_Z16C, graph_buhlmann_dive_profile, DiveProfileCheckpoint, Gas
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from deco import DiveProfile, Buhlmann_Z16C, graph_buhlmann_dive_profile, DiveProfileCheckpoint, Gas, TissueSnapshot, process_algorithms, WV_PRESSURE
 
 air = Gas()
 air_tec = Gas(ppo2=1.2)
@@ -128,10 +131,17 @@ class AscendDirectly():
         prev_checkpoint = dive_checkpoints[-1]
         return ChangeDepth(depth=0, time_s=self.time_s, speed_mm=self.speed_ms*60).get_new_checkpoints(dive_checkpoints)
 
+# the planner raises a plain Exception when it rejects a plan, so these are told apart from real errors by message
+PLANNER_REJECTIONS = ('Dive invalid', 'no permissible gas')
+
+class PlanningCancelled(Exception):
+    pass
+
 class GetMeHome():
-    def __init__(self, algorithm, available_gases=[air]) -> None:
+    def __init__(self, algorithm, available_gases=[air], cancel_event: threading.Event=None) -> None:
         self.algorithm = algorithm
         self.available_gases = available_gases
+        self.cancel_event = cancel_event
         pass
 
     @staticmethod
@@ -152,6 +162,8 @@ class GetMeHome():
         dive = DiveProfile(checkpoints=dive_checkpoints)
         count = 0
         while dive_checkpoints[-1].depth > 0 and dive_checkpoints[-1].time < 60*60*10:
+            if self.cancel_event and self.cancel_event.is_set():
+                raise PlanningCancelled()
             if count % 100 == 0:
                 valid = self.algorithm.process(dive)
                 if not valid:
@@ -181,9 +193,58 @@ class GetMeHome():
             count = count + 1
         return []  # TODO: make this make sense. right now, it directly modifies the object it takes in
 
+class QuickGetMeHome():
+    # coarse version of GetMeHome for instant feedback: same 3 m stops and gas choice, but the tissues are only
+    # updated once per step instead of every second. to stay conservative, an ascent step loads the tissues as if
+    # the whole step was spent at its deeper end on the richer of the two gases, and is only taken if the ceiling
+    # is above the new depth both before and after it
+    def __init__(self, algorithm, available_gases=[air], ascent_s=20, stop_step_s=60) -> None:
+        self.algorithm = algorithm
+        self.available_gases = available_gases
+        self.ascent_s = ascent_s
+        self.stop_step_s = stop_step_s
+
+    def get_new_checkpoints(self, dive_checkpoints):
+        # copies, so no states are cached in the caller's checkpoints
+        dive = DiveProfile(checkpoints=[
+            DiveProfileCheckpoint(time=checkpoint.time, depth=checkpoint.depth, gas=checkpoint.gas) for checkpoint in dive_checkpoints])
+        results = process_algorithms(dive, [self.algorithm])[self.algorithm]
+        if not results.valid:
+            # the same check GetMeHome makes before its first step, so a coarse plan is never shown for a dive
+            # the full planner would reject
+            raise Exception("Dive invalid at minute {}".format(dive_checkpoints[-1].time / 60))
+        ppn2 = results.ppn2[-1]
+        half_times = np.array([compartment.half_time_min for compartment in self.algorithm.compartments])
+        time = dive_checkpoints[-1].time
+        depth = dive_checkpoints[-1].depth
+        gas = dive_checkpoints[-1].gas
+        new_checkpoints = []
+        while depth > 0 and time < 60*60*10:
+            if depth % 3 == 0:
+                new_depth = depth - 3
+            else:
+                new_depth = depth // 3 * 3
+            new_gas = GetMeHome.get_best_deco_gas(self.available_gases, new_depth)
+            loading_gas = gas if gas.nitrogen >= new_gas.nitrogen else new_gas
+            new_ppn2 = self.update_ppn2(ppn2, half_times, depth, loading_gas, self.ascent_s)
+            if max(self.algorithm.ceilings(ppn2).max(), self.algorithm.ceilings(new_ppn2).max()) <= new_depth:
+                ppn2, time, depth, gas = new_ppn2, time + self.ascent_s, new_depth, new_gas
+            else:
+                ppn2, time = self.update_ppn2(ppn2, half_times, depth, gas, self.stop_step_s), time + self.stop_step_s
+            new_checkpoints.append(DiveProfileCheckpoint(time=time, depth=depth, gas=gas))
+        return new_checkpoints
+
+    @staticmethod
+    def update_ppn2(ppn2, half_times, depth, gas, time_spent):
+        inhaled_ppn2 = (1+(depth)/10 - WV_PRESSURE) * gas.nitrogen
+        return ppn2 + (inhaled_ppn2 - ppn2) * (1 - 2 ** (-(time_spent / 60) / half_times))
+
 
 def process_diveplan(dive_plan, initial_gas):
     dive_checkpoints = [DiveProfileCheckpoint(time=0, depth=0, gas=initial_gas)]
+    return continue_diveplan(dive_plan, dive_checkpoints)
+
+def continue_diveplan(dive_plan, dive_checkpoints):
     for i in range(len(dive_plan)):
         action = dive_plan[i]
         new_checkpoints = action.get_new_checkpoints(dive_checkpoints)
@@ -193,6 +254,54 @@ def process_diveplan(dive_plan, initial_gas):
             dive_checkpoints.append(new_checkpoints)
     return dive_checkpoints
 
+class Contingency():
+    # one variant of a plan, continued from a TissueSnapshot: optional extra actions (e.g. more bottom time),
+    # then a GetMeHome ascent with its own algorithm settings and gas list
+    def __init__(self, name, algorithm, available_gases=[air], dive_plan=[]) -> None:
+        self.name = name
+        self.algorithm = algorithm
+        self.available_gases = available_gases
+        self.dive_plan = dive_plan
+
+    def plan(self, snapshot: TissueSnapshot):
+        dive_checkpoints = [snapshot.seed_checkpoint(self.algorithm)]
+        dive_plan = [*self.dive_plan, GetMeHome(algorithm=self.algorithm, available_gases=self.available_gases)]
+        try:
+            dive_checkpoints = continue_diveplan(dive_plan, dive_checkpoints)
+        except Exception as e:
+            return ContingencyPlan(self, dive=None, valid=False, error=e)
+        dive = DiveProfile(checkpoints=dive_checkpoints)
+        valid = self.algorithm.process(dive)
+        return ContingencyPlan(self, dive=dive, valid=valid)
+
+class ContingencyPlan():
+    def __init__(self, contingency, dive=None, valid=None, error=None) -> None:
+        self.contingency = contingency
+        self.name = contingency.name
+        self.dive = dive
+        self.valid = valid
+        self.error = error
+
+    @property
+    def runtime_min(self):
+        if not self.dive:
+            return None
+        return self.dive[-1].time / 60
+
+    def __repr__(self) -> str:
+        return str((self.name, self.runtime_min, self.valid, self.error))
+
+    def __str__(self):
+        return str((self.name, self.runtime_min, self.valid, self.error))
+
+def plan_contingencies(snapshot: TissueSnapshot, contingencies, executor=None):
+    # the shared prefix of the dive is only computed once: every contingency starts from the snapshot.
+    if executor == None:
+        with ProcessPoolExecutor() as pool:
+            return plan_contingencies(snapshot, contingencies, executor=pool)
+    futures = [executor.submit(contingency.plan, snapshot) for contingency in contingencies]
+    return [future.result() for future in futures]
+
 buhlmann = Buhlmann_Z16C(gf=100)
 
 # dive_plan = [
@@ -240,7 +349,8 @@ rashi_halik = [
 ]
 dive_plan = make_dive_actions_from_list(rashi_halik)
 
-def make_dive_graph_from_command_list(command_list):
+def make_dive_plan_from_command_list(command_list, coarse=False, cancel_event=None):
+    # returns (dive, algorithm). coarse plans use QuickGetMeHome, and their results are not written into the dive
     chatbot_algo = Buhlmann_Z16C(gf=85)
 
     command_list = command_list.split('\n')
@@ -257,12 +367,50 @@ def make_dive_graph_from_command_list(command_list):
             time = int(line.split(" ")[0])
             dive_plan.append(MaintainDepth(time_min=time))
 
-    dive_plan.append(GetMeHome(algorithm=chatbot_algo, available_gases=[air]))
+    if coarse:
+        dive_plan.append(QuickGetMeHome(algorithm=chatbot_algo, available_gases=[air]))
+    else:
+        dive_plan.append(GetMeHome(algorithm=chatbot_algo, available_gases=[air], cancel_event=cancel_event))
     dive_checkpoints = process_diveplan(dive_plan, air)
     dive = DiveProfile(checkpoints=dive_checkpoints)
-    chatbot_algo.process(dive)
+    if not coarse:
+        chatbot_algo.process(dive)
+    return dive, chatbot_algo
+
+def make_dive_graph_from_command_list(command_list, coarse=False):
+    dive, chatbot_algo = make_dive_plan_from_command_list(command_list, coarse=coarse)
+    if coarse:
+        results = process_algorithms(dive, [chatbot_algo])[chatbot_algo]
+        return graph_buhlmann_dive_profile(dive, chatbot_algo, simple=True, results=results, provisional=True, sample_every_s=30)
     return graph_buhlmann_dive_profile(dive, chatbot_algo, simple=True)
 
+refinement_pool = ThreadPoolExecutor(max_workers=2)
+
+class DivePlanRefinement():
+    # plans a dive at full resolution in the background, while a coarse plan is shown.
+    # cancel() stops it at the next GetMeHome step, and result() then raises PlanningCancelled
+    def __init__(self, command_list) -> None:
+        self.cancel_event = threading.Event()
+        self.future = refinement_pool.submit(make_dive_plan_from_command_list, command_list, cancel_event=self.cancel_event)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        return self.future.result()
+
+    def graph(self):
+        # render on the caller's thread, pyplot isn't thread safe
+        dive, chatbot_algo = self.result()
+        return graph_buhlmann_dive_profile(dive, chatbot_algo, simple=True)
+
 dive_checkpoints = process_diveplan(dive_plan, air)
 dive = DiveProfile(checkpoints=dive_checkpoints)
 buhlmann.process(dive)
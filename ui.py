@@ -1,6 +1,7 @@
+import time
 import streamlit as st
 import replicate
-from planner import make_dive_graph_from_command_list
+from planner import make_dive_graph_from_command_list, DivePlanRefinement, PlanningCancelled, PLANNER_REJECTIONS
 
 def format_message_history_for_prompt(messages):
     def format_message(message):
@@ -11,9 +12,10 @@ def format_message_history_for_prompt(messages):
     return '\n'.join([format_message(message) for message in messages])
 
 class DivePlanMessage():
-    def __init__(self, text1=None, graph = None, graph_as_text=None, text2 = None, bot=None) -> None:
+    def __init__(self, text1=None, graph = None, graph_as_text=None, text2 = None, bot=None, provisional=False) -> None:
         self.text1 = text1
         self.graph = graph
+        self.provisional = provisional  # graph is the coarse plan, still being refined
         if graph_as_text:
             self.graph_as_text = "START DIVE\n" + graph_as_text + "\nEND DIVE"
         else:
@@ -105,6 +107,10 @@ for message in st.session_state.messages:
 
 # Accept user input
 if prompt := st.chat_input("What is up?"):
+    # a new message makes any plan still being refined obsolete
+    if "refinement" in st.session_state:
+        st.session_state.refinement.cancel()
+        del st.session_state.refinement
     # Add user message to chat history
     st.session_state.messages.append(DivePlanMessage(bot=False, text1=prompt))
     printing_commands = False
@@ -142,9 +148,16 @@ if prompt := st.chat_input("What is up?"):
             segmented_response = [segmented_response]
 
         response_in_progress = ""
+        plan_error = None
         if len(segmented_response) > 2:
             graph_as_text = segmented_response[1]
-            graph = make_dive_graph_from_command_list(graph_as_text)
+            # a coarse plan first, the full resolution one is only started once this is on screen
+            try:
+                graph = make_dive_graph_from_command_list(graph_as_text, coarse=True)
+            except Exception as e:
+                if not str(e).startswith(PLANNER_REJECTIONS):
+                    raise
+                plan_error = e
             response_in_progress = segmented_response[2]
 
         text1 = segmented_response[0]
@@ -152,6 +165,40 @@ if prompt := st.chat_input("What is up?"):
         text1_position.markdown(text1)
         text2 = response_in_progress
         text2_position.markdown(text2)
-        graph_position.pyplot(graph)
+        if plan_error:
+            graph_position.error("I can't plan this dive: {}".format(plan_error))
+        else:
+            graph_position.pyplot(graph)
+        provisional = graph_as_text != None and not plan_error
+        if provisional:
+            # started after the coarse graph is shown, so it can't slow that down by competing for the interpreter
+            st.session_state.refinement = DivePlanRefinement(graph_as_text)
         # Add assistant response to chat history
-        st.session_state.messages.append(DivePlanMessage(text1=text1, text2=text2, graph=graph, graph_as_text = graph_as_text, bot=True))
+        message = DivePlanMessage(text1=text1, text2=text2, graph=graph, graph_as_text = graph_as_text, bot=True, provisional=provisional)
+        st.session_state.messages.append(message)
+
+        if message.provisional:
+            refinement = st.session_state.refinement
+            status_position = st.empty()
+            try:
+                while not refinement.done():
+                    # updating the page lets streamlit stop this run if another message arrives
+                    status_position.caption("Provisional plan, working out the exact schedule...")
+                    time.sleep(0.1)
+                graph = refinement.graph()
+                graph_position.pyplot(graph)
+                message.graph = graph
+            except PlanningCancelled:
+                pass
+            except Exception as e:
+                if not str(e).startswith(PLANNER_REJECTIONS):
+                    raise
+                graph_position.error("I can't plan this dive: {}".format(e))
+                message.graph = None
+            finally:
+                # also reached when streamlit stops this run, so nothing is left refining in the background
+                refinement.cancel()
+                status_position.empty()
+                message.provisional = False
+                if st.session_state.get("refinement") is refinement:
+                    del st.session_state.refinement